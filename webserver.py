@@ -1,182 +1,625 @@
 import board
 import busio
 import adafruit_pca9685
+import fcntl
+import functools
+import logging
+import math
+import os
+import queue
+import signal
 import socketio
 import threading
 import time
 
-from adafruit_servokit import ServoKit
+from array import array
 
+log = logging.getLogger(__name__)
+
+# Keep retrying quickly after a Wi-Fi drop instead of giving up after a
+# few attempts
 sio = socketio.Client(
   reconnection=True,
-  reconnection_attempts=5,
-  reconnection_delay=1,
-  reconnection_delay_max=5
+  reconnection_attempts=0,
+  reconnection_delay=0.3,
+  reconnection_delay_max=3,
+  randomization_factor=0.3,
+  # shutdown() below handles SIGINT itself
+  handle_sigint=False,
+  # MessagePack packets are smaller and cheaper to decode than JSON for
+  # the stream of 'move' lists. The server has to use the same parser
+  serializer='msgpack'
 )
 
-i2c = board.I2C()
-hat = adafruit_pca9685.PCA9685(i2c)
+PWM_FREQUENCY = 50
 
-# Set the PWM frequency to 50Hz (standard for most servos)
-hat.frequency = 50
+# Servo updates are limited by the I2C bus rather than the CPU, so the bus
+# should run in fast mode (dtparam=i2c_arm_baudrate=400000)
+I2C_CLOCK_FREQUENCY_PATH = '/sys/class/i2c-adapter/i2c-1/of_node/clock-frequency'
+I2C_BAUDRATE = 400000
 
-kit = ServoKit(channels=16)
+# First register of channel 0 (ON_L, ON_H, OFF_L, OFF_H); each channel's
+# four registers follow on from the previous one
+LED0_ON_L = 0x06
+CHANNEL_START = [LED0_ON_L + 4 * channel for channel in range(16)]
 
-# Initialize all continuous servos to stop position (throttle=0)
-for i in range(4):
-    kit.continuous_servo[i].throttle = 0
+PCA9685_ADDRESS = 0x40
+
+# Raw i2c-dev node and its I2C_SLAVE ioctl (linux/i2c-dev.h)
+I2C_DEVICE_PATH = '/dev/i2c-1'
+I2C_SLAVE = 0x0703
+
+# Every PCA9685 access and movement state change goes through this lock so
+# the socket, movement and worker threads can't interleave bus writes
+i2c_lock = threading.RLock()
+
+# Last OFF count written to each channel, None until it has been written
+last_pulses = [None] * 16
+
+# Scratch buffer for set_pwm_bulk: start register plus ON_L..OFF_H for up
+# to 16 channels. ON is always 0, so only the OFF bytes are ever filled in
+pwm_buf = bytearray(1 + 4 * 16)
+pwm_view = memoryview(pwm_buf)
+
+# PCA9685 MODE1 register bits
+MODE1_SLEEP = 0x10
+MODE1_AUTO_INCREMENT = 0x20
+MODE1_RESTART = 0x80
+
+# ServoKit's default servo pulse range in microseconds
+SERVO_MIN_PULSE = 750
+SERVO_MAX_PULSE = 2250
+SERVO_NEUTRAL = (SERVO_MIN_PULSE + SERVO_MAX_PULSE) / 2
+SERVO_ACTUATION_RANGE = 180
+
+# These only run at import, to build NEUTRAL_PULSES and the lookup tables
+# below; commands are converted through throttle_to_bits/angle_to_bits
+
+def throttle_to_pulse(throttle):
+  throttle = max(-1.0, min(1.0, throttle))
+  return SERVO_NEUTRAL + throttle * (SERVO_MAX_PULSE - SERVO_NEUTRAL)
+
+def angle_to_pulse(angle):
+  angle = max(0, min(SERVO_ACTUATION_RANGE, angle))
+  return SERVO_MIN_PULSE + angle * ((SERVO_MAX_PULSE - SERVO_MIN_PULSE) /
+                                    SERVO_ACTUATION_RANGE)
+
+def pulse_to_bits(pulse):
+  # 12-bit PCA9685 OFF count for a pulse width in microseconds
+  return int(pulse * (PWM_FREQUENCY * 4096 / 1000000))
+
+def set_pwm_bulk(start_channel, pulses, force=False):
+  # Write ON_L..OFF_H of consecutive channels in a single auto-increment
+  # transaction rather than one per register or per channel
+  with i2c_lock:
+    if not force:
+      # Trim the burst to the channels whose value actually changed
+      first, last = 0, len(pulses)
+      while first < last and last_pulses[start_channel + first] == pulses[first]:
+        first += 1
+      if first == last:
+        return
+      while last_pulses[start_channel + last - 1] == pulses[last - 1]:
+        last -= 1
+      start_channel += first
+      pulses = pulses[first:last]
+
+    pwm_buf[0] = CHANNEL_START[start_channel]
+    for i, off in enumerate(pulses):
+      pwm_buf[4 * i + 3] = off & 0xFF
+      pwm_buf[4 * i + 4] = off >> 8
+    buf = pwm_view[:1 + 4 * len(pulses)]
+    if pca_fd is not None:
+      # One write() syscall, and the GIL is released while it runs
+      os.write(pca_fd, buf)
+    else:
+      with hat.i2c_device as device:
+        device.write(buf)
+    last_pulses[start_channel:start_channel + len(pulses)] = pulses
+
+def try_pwm_bulk(start_channel, pulses, force=False):
+  # For the loops that enforce the stop timeouts: a glitch on the bus is
+  # logged instead of ending the loop. last_pulses keeps the old values, so
+  # the next write of the same pulses isn't skipped
+  try:
+    set_pwm_bulk(start_channel, pulses, force)
+  except OSError as e:
+    log.warning("PCA9685 write failed: %s", e)
+
+def set_pwm_freq(freq_hz):
+  # PCA9685.__init__ has just reset MODE1 to 0x00, so write known values
+  # instead of reading MODE1 back around the prescale change
+  prescale = int(hat.reference_clock_speed / 4096.0 / freq_hz + 0.5) - 1
+  with i2c_lock:
+    hat.mode1_reg = MODE1_SLEEP
+    hat.prescale_reg = prescale
+    hat.mode1_reg = 0x00
+    # The oscillator needs 500us to settle after leaving sleep
+    time.sleep(0.0005)
+    hat.mode1_reg = MODE1_RESTART | MODE1_AUTO_INCREMENT
 
-# Initialize standard servo to neutral position
-kit.servo[4].angle = 90
+def open_pca_fd():
+  # Servo updates go straight to the i2c-dev node rather than through
+  # Blinka's busio layer, which adds its own bus locking and buffer copies
+  # to every write
+  try:
+    fd = os.open(I2C_DEVICE_PATH, os.O_RDWR)
+  except OSError:
+    return None
+  try:
+    fcntl.ioctl(fd, I2C_SLAVE, PCA9685_ADDRESS)
+  except OSError:
+    os.close(fd)
+    return None
+  return fd
+
+def check_i2c_baudrate():
+  try:
+    with open(I2C_CLOCK_FREQUENCY_PATH, 'rb') as f:
+      # Device tree properties are stored as big-endian 32-bit cells
+      baudrate = int.from_bytes(f.read(4), 'big')
+  except OSError:
+    # No device tree entry, nothing to check
+    return
+  if baudrate < I2C_BAUDRATE:
+    log.warning("I2C bus runs at %dHz, servo updates are bus-bound; "
+                "set dtparam=i2c_arm_baudrate=%d in /boot/config.txt",
+                baudrate, I2C_BAUDRATE)
+
+# The stop position never changes, so work out its pulses once up front
+NEUTRAL_PULSES = (pulse_to_bits(throttle_to_pulse(0)),) * 4
+LIFT_NEUTRAL_PULSE = pulse_to_bits(angle_to_pulse(90))
+
+# Commands only ever land on a few hundred distinct OFF counts, so both
+# conversions are tabulated once: throttle in 0.001 steps, angle in degrees
+THROTTLE_STEPS = 1000
+THROTTLE_LUT = array('H', [pulse_to_bits(throttle_to_pulse(i / THROTTLE_STEPS - 1.0))
+                           for i in range(2 * THROTTLE_STEPS + 1)])
+ANGLE_LUT = array('H', [pulse_to_bits(angle_to_pulse(angle))
+                        for angle in range(SERVO_ACTUATION_RANGE + 1)])
+
+def throttle_to_bits(throttle, _lut=THROTTLE_LUT, _steps=THROTTLE_STEPS, _int=int):
+  index = _int((throttle + 1.0) * _steps + 0.5)
+  if index > 2 * _steps:
+    index = 2 * _steps
+  elif index < 0:
+    index = 0
+  return _lut[index]
+
+def angle_to_bits(angle, _lut=ANGLE_LUT, _range=SERVO_ACTUATION_RANGE, _int=int):
+  index = _int(angle + 0.5)
+  if index > _range:
+    index = _range
+  elif index < 0:
+    index = 0
+  return _lut[index]
+
+# Joysticks held steady resend the same thresholds, so the immutable pulse
+# tuple for each recent set is kept rather than rebuilt on every packet
+@functools.lru_cache(maxsize=256)
+def thresholds_to_pulses(thresholds):
+  return tuple([throttle_to_bits(t) for t in thresholds])
 
-movement = False
+# Set up by init_hardware() on startup rather than at import
+i2c = None
+hat = None
+pca_fd = None
+
+def init_hardware():
+  global i2c, hat, pca_fd
+  # Ask for fast mode. On the Pi the kernel owns the bus clock, so this only
+  # takes effect through dtparam, which check_i2c_baudrate() verifies
+  i2c = busio.I2C(board.SCL, board.SDA, frequency=I2C_BAUDRATE)
+  check_i2c_baudrate()
+  hat = adafruit_pca9685.PCA9685(i2c, address=PCA9685_ADDRESS)
+  pca_fd = open_pca_fd()
+
+  # Set the PWM frequency to 50Hz (standard for most servos). This also turns
+  # on the PCA9685 register auto-increment that set_pwm_bulk relies on
+  set_pwm_freq(PWM_FREQUENCY)
+
+  # Initialize all 16 channels in one transaction: continuous servos to stop
+  # position (throttle=0), the standard servo to neutral, the rest off
+  set_pwm_bulk(0, NEUTRAL_PULSES + (LIFT_NEUTRAL_PULSE,) + (0,) * 11, force=True)
+
+# The current move_loop's stop Event, set while the wheels are stopped.
+# start_movement gives each new loop a fresh one, so a loop that is still
+# winding down after stop_movement() can't be revived by the next 'move'
+stop_event = threading.Event()
+stop_event.set()
 movement_thread = None
 current_direction = None
-wheel_thresholds = [0, 0, 0, 0]
-stop_timer = None
+# 12-bit OFF counts for channels 0-3, quantized once when a 'move' arrives.
+# Always a tuple that gets rebound, never changed in place, so one read
+# gives move_loop a consistent set of four wheels
+wheel_pulses = NEUTRAL_PULSES
+
+# When no 'move' has arrived for MOVE_STALE_TIMEOUT the wheels go to
+# neutral; after STOP_TIMEOUT move_loop exits. Idling the wheels early is
+# what makes the longer stop timeout safe
+MOVE_STALE_TIMEOUT = 0.25
+STOP_TIMEOUT = 2.0
+
+# perf_counter() time of the last 'move'
+last_move_time = 0.0
+
+# How often a moving servo is re-asserted when no new command arrives
+HEARTBEAT_INTERVAL = 0.2
+
+# Bursts of 'move'/'lift' events inside this window become one I2C write
+COALESCE_WINDOW = 0.02
 
-def move_loop():
-  global movement, current_direction, wheel_thresholds
-  while movement:
-    if current_direction == 'move' and wheel_thresholds:
-      # Apply the thresholds directly
-      kit.continuous_servo[0].throttle = wheel_thresholds[0]
-      kit.continuous_servo[1].throttle = wheel_thresholds[1]
-      kit.continuous_servo[2].throttle = wheel_thresholds[2]
-      kit.continuous_servo[3].throttle = wheel_thresholds[3]
+# Real-time priority and CPU for move_loop (see README)
+MOVE_LOOP_PRIORITY = 50
+MOVE_LOOP_CPU = 3
 
-    time.sleep(0.01)
+# (direction, wheel pulses) handed from the socket handlers to move_loop.
+# It holds a single command so a stale one can never be applied late
+command_queue = queue.Queue(maxsize=1)
+update_event = threading.Event()
+last_command = None
+
+# PCA9685 output the lift servo is wired to
+LIFT_CHANNEL = 4
+# OFF count for the newest 'lift' angle, picked up by lift_loop when
+# lift_event is set
+latest_lift = LIFT_NEUTRAL_PULSE
+lift_event = threading.Event()
+
+def set_realtime_priority():
+  # SCHED_FIFO keeps kernel work and other processes from delaying wheel
+  # updates. It needs root or CAP_SYS_NICE; without it the loop carries on
+  # at normal priority
+  if not hasattr(os, 'SCHED_FIFO'):
+    return
+  try:
+    # pid 0 is the calling thread
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(MOVE_LOOP_PRIORITY))
+  except OSError as e:
+    log.debug("could not set real-time priority: %s", e)
+  try:
+    if MOVE_LOOP_CPU in os.sched_getaffinity(0):
+      os.sched_setaffinity(0, {MOVE_LOOP_CPU})
+  except OSError as e:
+    log.debug("could not pin move_loop to CPU %d: %s", MOVE_LOOP_CPU, e)
+
+def move_loop(stop):
+  set_realtime_priority()
+  try:
+    drive_wheels(stop)
+  except Exception:
+    log.exception("move_loop failed")
+  finally:
+    # However the loop ends, it must not leave the wheels driving with its
+    # stop Event clear, or no later 'move' would start a new loop. Once it
+    # is set, stop_movement() or the stop timeout already wrote neutral
+    with i2c_lock:
+      if not stop.is_set():
+        stop.set()
+        try_pwm_bulk(0, NEUTRAL_PULSES)
+
+def drive_wheels(stop):
+  global current_direction, wheel_pulses, last_command
+  # Bind what the loop calls every pass as locals (LOAD_FAST rather than a
+  # globals() lookup). The names it reassigns stay global because the
+  # socket handlers read them
+  perf_counter = time.perf_counter
+  stopped = stop.is_set
+  wait_update = update_event.wait
+  clear_update = update_event.clear
+  next_command = command_queue.get_nowait
+  write = try_pwm_bulk
+  lock = i2c_lock
+  Empty = queue.Empty
+  neutral = NEUTRAL_PULSES
+  last_write = 0.0
+  next_tick = perf_counter() + HEARTBEAT_INTERVAL
+  # True once the wheels were idled because the controller went quiet
+  idle = False
+  while not stopped():
+    # Block until a new command arrives, the next heartbeat is due or the
+    # controller has been quiet for too long, instead of polling the bus
+    deadline = last_move_time + (STOP_TIMEOUT if idle else MOVE_STALE_TIMEOUT)
+    updated = wait_update(max(0.0, min(next_tick, deadline) - perf_counter()))
+    if stopped():
+      break
+
+    # Deadlines are checked again under the lock: a 'move' updates
+    # last_move_time before it takes the lock in start_movement, so either
+    # it sees what we did here or we see its new timestamp. Every block
+    # under the lock also re-checks stop, since stop_movement() and
+    # start_movement() only change it while holding the lock
+    if perf_counter() >= last_move_time + STOP_TIMEOUT:
+      with lock:
+        if stopped():
+          break
+        if perf_counter() >= last_move_time + STOP_TIMEOUT:
+          stop.set()
+          write(0, neutral)
+          break
+      continue
+
+    if not idle and perf_counter() >= last_move_time + MOVE_STALE_TIMEOUT:
+      with lock:
+        if stopped():
+          break
+        if perf_counter() >= last_move_time + MOVE_STALE_TIMEOUT:
+          # Stop driving on a stale command. Forget it so the next 'move'
+          # is applied even if it repeats the same thresholds
+          idle = True
+          wheel_pulses = neutral
+          last_command = None
+          write(0, neutral)
+      continue
+
+    if updated:
+      # Let a burst of joystick packets settle so only the newest is written
+      hold = last_write + COALESCE_WINDOW - perf_counter()
+      if hold > 0 and stop.wait(hold):
+        break
+      with lock:
+        # Once stopped, the queued command belongs to the next loop
+        if stopped():
+          break
+        clear_update()
+        try:
+          current_direction, wheel_pulses = next_command()
+          idle = False
+        except Empty:
+          pass
+
+        if current_direction == 'move' and not idle:
+          write(0, wheel_pulses)
+          last_write = perf_counter()
+          next_tick = last_write + HEARTBEAT_INTERVAL
+    elif perf_counter() >= next_tick:
+      with lock:
+        if stopped():
+          break
+        if current_direction == 'move' and wheel_pulses != neutral:
+          # Heartbeat: re-assert the wheels while any of them is driving,
+          # even though the cache says they are already set
+          write(0, wheel_pulses, force=True)
+        else:
+          # Free when the wheels are already neutral, and retries a neutral
+          # write that failed
+          write(0, neutral)
+      # Keep a fixed cadence from the previous tick, but start over from
+      # now after an overrun instead of firing a backlog of ticks
+      next_tick += HEARTBEAT_INTERVAL
+      now = perf_counter()
+      if next_tick <= now:
+        next_tick = now + HEARTBEAT_INTERVAL
+
+def post_command(command):
+  # Replace whatever command move_loop hasn't picked up yet. Callers hold
+  # i2c_lock, so nothing can refill the queue between the get and the put
+  try:
+    command_queue.get_nowait()
+  except queue.Empty:
+    pass
+  command_queue.put_nowait(command)
 
 def start_movement(direction, thresholds=None):
-  global movement, movement_thread, current_direction, wheel_thresholds
-  if thresholds:
-    wheel_thresholds = thresholds
-  if not movement:
-    movement = True
-    current_direction = direction
-    movement_thread = threading.Thread(target=move_loop)
-    movement_thread.start()
-  else:
-    current_direction = direction  # Switch direction while moving
+  global movement_thread, last_command, stop_event
+  with i2c_lock:
+    if thresholds:
+      # Quantize once here so move_loop never touches floats
+      pulses = thresholds_to_pulses(tuple(thresholds))
+    else:
+      pulses = last_command[1] if last_command else wheel_pulses
+
+    # Only wake move_loop when the command actually changed, or when a
+    # fresh move_loop needs its first command. Comparing quantized pulses
+    # also skips float jitter too small to change the output
+    command = (direction, pulses)
+    if command != last_command or stop_event.is_set():
+      last_command = command
+      post_command(command)
+      update_event.set()
+
+    if stop_event.is_set():
+      stop_event = threading.Event()
+      movement_thread = threading.Thread(target=move_loop, args=(stop_event,))
+      movement_thread.start()
 
 def stop_movement():
-  global movement, movement_thread, stop_timer
-  movement = False
-  kit.continuous_servo[0].throttle = 0
-  kit.continuous_servo[1].throttle = 0
-  kit.continuous_servo[2].throttle = 0
-  kit.continuous_servo[3].throttle = 0
-  if movement_thread:
-    movement_thread.join()
+  global movement_thread
+  with i2c_lock:
+    stop_event.set()
+    # Also wake the wait for the next command so move_loop exits right away
+    update_event.set()
+    thread = movement_thread
     movement_thread = None
-  
-  # Clear the timer reference
-  stop_timer = None
+  # Join outside the lock, move_loop may be waiting on it for a write
+  if thread:
+    thread.join()
+  neutral_if_stopped()
+
+def neutral_if_stopped():
+  with i2c_lock:
+    # Don't undo a movement that started in the meantime
+    if stop_event.is_set():
+      try_pwm_bulk(0, NEUTRAL_PULSES)
+
+def note_move():
+  global last_move_time
+  last_move_time = time.perf_counter()
+
+def lift_loop():
+  # One long-running thread instead of a Timer thread per burst of angles
+  while True:
+    lift_event.wait()
+    lift_event.clear()
+    try:
+      set_pwm_bulk(LIFT_CHANNEL, (latest_lift,))
+    except Exception:
+      # The next 'lift' tries again, see on_lift
+      log.exception("lift write failed")
+    # Angles arriving during this window are folded into the next write
+    time.sleep(COALESCE_WINDOW)
+
+lift_thread = threading.Thread(target=lift_loop, daemon=True)
 
 @sio.event
 def connect():
-  print("connected to socket server")
+  log.info("connected to socket server")
   sio.emit('initializeDevice', {'deviceType': 'terrE', 'unit': '0.1'})
 
 @sio.event
 def disconnect():
-  print("disconnected from server")
+  log.info("disconnected from server")
+  # Don't keep driving on the last command while the link is down
+  cancel_diagnostics()
+  stop_movement()
+
+def is_throttle(value):
+  # bool is an int subclass but never a throttle; NaN and inf can't be
+  # quantized
+  return type(value) in (int, float) and math.isfinite(value)
 
 @sio.on('move')
 def on_move(thresholds):
-  global stop_timer
-  print(f"move with thresholds: {thresholds}")
+  # Hot handlers log at debug so nothing is formatted unless enabled
+  log.debug("move with thresholds: %s", thresholds)
+  # One finite throttle per wheel. More would spill onto the lift servo
+  # on channel 4, and a rejected packet mustn't count as a fresh 'move'
+  if (not isinstance(thresholds, (list, tuple)) or
+      len(thresholds) != len(NEUTRAL_PULSES) or
+      not all(is_throttle(t) for t in thresholds)):
+    log.warning("move needs %d numeric thresholds: %r", len(NEUTRAL_PULSES), thresholds)
+    return
+  # Record the time before moving so move_loop can't act on the previous
+  # stale/stop deadline
+  note_move()
   start_movement('move', thresholds)
-  
-  # Cancel any existing timer to prevent jerky movement
-  if stop_timer:
-    stop_timer.cancel()
-  
-  # Create a new timer
-  stop_timer = threading.Timer(0.6, stop_movement)
-  stop_timer.start()
 
 @sio.on('lift')
 def on_lift(angle):
-  print(f"lift servo to angle: {angle}")
+  global latest_lift
+  log.debug("lift servo to angle: %s", angle)
   # Standard servos use angle values from 0 to 180 degrees
   # Ensure angle is within valid range
   angle = max(0, min(180, angle))
-  kit.servo[4].angle = angle
+  # A held slider keeps resending the same angle. Don't wake lift_loop
+  # when that angle is both the one pending and the one on the servo, so
+  # a write that failed is retried by the next 'lift'
+  bits = angle_to_bits(angle)
+  if bits == latest_lift and bits == last_pulses[LIFT_CHANNEL]:
+    return
+  # Slider drags send a stream of angles; lift_loop writes at most one
+  # per COALESCE_WINDOW, always the newest
+  latest_lift = bits
+  lift_event.set()
 
 @sio.on('stop')
 def on_stop():
-  print("stop")
+  log.info("stop")
+  cancel_diagnostics()
   stop_movement()
 
-# Diagnostic handlers for individual servos
-@sio.on('0')
-def on_servo_0(value):
-    global movement, movement_thread
-    print(f"servo 0 throttle {value}")
-    movement = False
-    if movement_thread:
-        movement_thread.join()
-        movement_thread = None
-    # Set all to 0
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-    kit.continuous_servo[0].throttle = value
-    time.sleep(1)
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-
-@sio.on('1')
-def on_servo_1(value):
-    global movement, movement_thread
-    print(f"servo 1 throttle {value}")
-    movement = False
-    if movement_thread:
-        movement_thread.join()
-        movement_thread = None
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-    kit.continuous_servo[1].throttle = value
-    time.sleep(1)
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-
-@sio.on('2')
-def on_servo_2(value):
-    global movement, movement_thread
-    print(f"servo 2 throttle {value}")
-    movement = False
-    if movement_thread:
-        movement_thread.join()
-        movement_thread = None
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-    kit.continuous_servo[2].throttle = value
-    time.sleep(1)
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-
-@sio.on('3')
-def on_servo_3(value):
-    global movement, movement_thread
-    print(f"servo 3 throttle {value}")
-    movement = False
-    if movement_thread:
-        movement_thread.join()
-        movement_thread = None
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
-    kit.continuous_servo[3].throttle = value
-    time.sleep(1)
-    for i in range(4):
-        kit.continuous_servo[i].throttle = 0
+# How long a diagnostic command drives its wheel
+DIAG_DURATION = 1.0
+
+# (channel, throttle, duration, cancel) for diag_loop, so the socket
+# handlers never sit on the bus or in the diagnostic sleep themselves
+diag_queue = queue.Queue()
+# Cancel Events of the diagnostics that are queued or running. Each has its
+# own, so cancelling never races with diag_loop picking up the next one
+diag_pending = set()
+# Reentrant: shutdown() runs as a signal handler, so a second signal can
+# land while the main thread is already inside cancel_diagnostics()
+diag_lock = threading.RLock()
+
+def cancel_diagnostics():
+  # Ends the running diagnostic and drops the queued ones
+  with diag_lock:
+    # Take the tokens out first, a reentrant call could change the set
+    # while it's being walked
+    pending = list(diag_pending)
+    diag_pending.clear()
+    for cancel in pending:
+      cancel.set()
+    while True:
+      try:
+        diag_queue.get_nowait()
+      except queue.Empty:
+        break
+
+def diag_loop():
+  while True:
+    channel, value, duration, cancel = diag_queue.get()
+    if cancel.is_set():
+      continue
+    # A bad payload or bus error fails this diagnostic, not the thread
+    try:
+      # Stops the movement thread and sets all wheels to 0
+      stop_movement()
+      if not cancel.is_set():
+        set_pwm_bulk(channel, (throttle_to_bits(value),))
+        cancel.wait(duration)
+    except Exception:
+      log.exception("diagnostic on channel %s failed", channel)
+    with diag_lock:
+      diag_pending.discard(cancel)
+    neutral_if_stopped()
+
+diag_thread = threading.Thread(target=diag_loop, daemon=True)
+
+# Diagnostic throttle for one wheel. Only the wheels, since diag_loop puts
+# channels 0-3 back to neutral when it's done
+def drive_servo(channel, value):
+  # Checked here so a bad payload never reaches the bus code; channel
+  # indexes last_pulses, so 1.0 or True won't do
+  if (type(channel) is not int or
+      not 0 <= channel < len(NEUTRAL_PULSES)):
+    log.warning("no wheel on channel %r", channel)
+    return
+  log.info("servo %d throttle %s", channel, value)
+  # The newest diagnostic replaces any earlier one
+  cancel_diagnostics()
+  cancel = threading.Event()
+  with diag_lock:
+    diag_pending.add(cancel)
+    diag_queue.put((channel, value, DIAG_DURATION, cancel))
+
+@sio.on('servo')
+def on_servo(payload):
+  try:
+    channel, value = payload['channel'], payload['value']
+  except (KeyError, TypeError):
+    log.warning("servo payload needs channel and value: %r", payload)
+    return
+  drive_servo(channel, value)
+
+# Older senders still use one event per wheel ('0'-'3')
+for i in range(4):
+  sio.on(str(i), functools.partial(drive_servo, i))
+
+def shutdown(signum, frame):
+  # Zero the wheels as soon as the signal lands, then let sio.wait()
+  # return through the disconnect
+  log.info("received signal %d, shutting down", signum)
+  cancel_diagnostics()
+  stop_movement()
+  sio.disconnect()
 
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  init_hardware()
+  diag_thread.start()
+  lift_thread.start()
+  # SIGTERM is what systemd sends on stop
+  signal.signal(signal.SIGINT, shutdown)
+  signal.signal(signal.SIGTERM, shutdown)
   try:
     sio.connect('http://192.168.86.34:3000')
+    # Returns once shutdown() disconnects, or when the server ends the
+    # session for good, so systemd can restart us. Signals still interrupt
+    # the wait, and the wheels stop in shutdown() before anything else
     sio.wait()
   except Exception as e:
-    print(f"connect error: {e}")
+    log.error("connect error: %s", e)
   finally:
     stop_movement()
     if sio.connected: